@@ -13,27 +13,231 @@
 # You might want to redirect the output to a file, like this:
 #   python3 ip-expand.py > expanded.txt
 #
+# The list is streamed: lines are read lazily, each range is expanded in
+# chunks of `--chunk` addresses and every chunk is written at once, so
+# memory stays flat even for /8s and output starts right away.  Use
+# `-o <PATH>` to write to a file instead of stdout.
+#
+# Overlapping and duplicate CIDRs are merged first, so every address is
+# written exactly once.  `--merge` picks the comment of an address covered
+# by several ranges: `join` (default) all of them in input order, `first`
+# or `last` in the list, or the most `specific` range.  `--merge none`
+# expands every line on its own, as before.
+#
+# Big lists are CPU-bound on formatting, so `--workers <N>` shards the
+# chunks across N processes; each one renders its chunk to bytes and the
+# chunks are written back in input order, with at most two in flight per
+# worker.  `--bench` prints the scaling curve from 1 to the number of CPUs,
+# or to `--workers` if higher (output goes to /dev/null):
+#   python3 ip-expand.py --workers 4 > expanded.txt
+#   python3 ip-expand.py --bench
+#
+# `--format` changes what is written: `text` (default) the lines above,
+# `range` one `<first>-<last>  // <comment>` line per merged range with no
+# expansion at all, `binary` each address as a packed big-endian uint32
+# (no comments), and `gzip` the text lines compressed.  In gzip mode every
+# chunk is compressed by its worker as a separate gzip member; members
+# concatenate into a valid stream that gunzip/zcat read as one file.
+#
+# With `--table <PATH>` the ranges are compiled into a binary range table
+# instead (see `ipv4.IPv4RangeIndex`), which lookup processes can mmap
+# rather than expanding or re-parsing the list:
+#   python3 ip-expand.py --table ranges.bin
+#
 # AUTHOR.: Joe Lopes <lopes.id>
 # DATE...: 2024-08-06
 # LICENSE: MIT
 ##
 
 
-from re import compile
-from ipaddress import IPv4Network
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from gzip import compress
+from os import cpu_count, devnull
+from sys import byteorder, stderr, stdout
+from time import perf_counter
+
+from ipv4 import IPv4, IPv4Array, IPv4RangeIndex, read_ranges
+
+
+def ranges(path):
+  '''Lazily yields (first, last, comment) from the ranges list.'''
+  with open(path, 'r') as f:
+    yield from read_ranges(f)
+
+
+def combine(rule, active):
+  '''Picks the comment for addresses covered by the `active` ranges.
+
+  `active` maps each range's position in the list to the range.
+  '''
+  if rule == 'first':
+    return active[min(active)][2]
+  if rule == 'last':
+    return active[max(active)][2]
+  if rule == 'specific':
+    i = min(active, key=lambda i: (active[i][1] - active[i][0], -i))
+    return active[i][2]
+  return ' | '.join(dict.fromkeys(active[i][2] for i in sorted(active)))
+
+
+def merge(ranges, rule):
+  '''Cuts overlapping ranges into disjoint ones, sorted by address.
+
+  Boundaries are swept in order keeping the set of ranges covering
+  the current interval; neighbours with the same comment are joined.
+  '''
+  ranges = list(ranges)
+  events = list()
+  for i, (first, last, _) in enumerate(ranges):
+    events.append((first, 1, i))
+    events.append((last + 1, 0, i))
+  events.sort()
+
+  merged = list()
+  active = dict()
+  pos = 0
+  for point, opens, i in events:
+    if active and pos < point:
+      comm = combine(rule, active)
+      if merged and merged[-1][2] == comm and merged[-1][1] + 1 == pos:
+        merged[-1] = (merged[-1][0], point - 1, comm)
+      else:
+        merged.append((pos, point - 1, comm))
+    pos = point
+    if opens:
+      active[i] = ranges[i]
+    else:
+      del active[i]
+  return merged
+
+
+def blocks(items, chunk):
+  '''Splits ranges into (first, last, comment) of `chunk` addresses.'''
+  for first, last, comm in items:
+    for start in range(first, last + 1, chunk):
+      yield start, min(start + chunk - 1, last), comm
+
+
+def render(block):
+  '''Formats a block as `<addr>  // <comment>` lines, in bytes.'''
+  first, last, comm = block
+  suffix = f'  // {comm}\n'
+  addrs = IPv4Array.from_numbers(range(first, last + 1))
+  return (suffix.join(addrs.to_strings()) + suffix).encode()
+
+
+def render_binary(block):
+  '''Packs a block as big-endian uint32 addresses.'''
+  addrs = IPv4Array.from_numbers(range(block[0], block[1] + 1)).addrs
+  if byteorder == 'little':
+    addrs.byteswap()
+  return addrs.tobytes()
+
+
+def render_gzip(block):
+  '''Formats a block like render() as a standalone gzip member.'''
+  return compress(render(block), compresslevel=6)
+
+
+renderers = {
+  'text': render,
+  'binary': render_binary,
+  'gzip': render_gzip
+}
+
+
+def write_ranges(items, out):
+  '''Writes one `<first>-<last>  // <comment>` line per range.'''
+  ip = IPv4()
+  count = 0
+  for first, last, comm in items:
+    out.write(f'{ip.to_string(first)}-{ip.to_string(last)}  // {comm}\n'.encode())
+    count += last - first + 1
+  return count
+
+
+def expand(items, out, chunk, workers=1, fmt='text'):
+  '''Writes every block to `out` in order and returns the address count.'''
+  if fmt == 'range':
+    return write_ranges(items, out)
+
+  render_block = renderers[fmt]
+  count = 0
+  if workers <= 1:
+    for block in blocks(items, chunk):
+      out.write(render_block(block))
+      count += block[1] - block[0] + 1
+    return count
+
+  with ProcessPoolExecutor(workers) as pool:
+    pending = deque()
+    for block in blocks(items, chunk):
+      if len(pending) >= 2 * workers:
+        out.write(pending.popleft().result())
+      pending.append(pool.submit(render_block, block))
+      count += block[1] - block[0] + 1
+    while pending:
+      out.write(pending.popleft().result())
+  return count
+
+
+def bench(items, chunk, top, fmt='text'):
+  '''Prints the expansion time for 1, 2, 4... up to `top` workers.'''
+  items = list(items)
+  steps, n = list(), 1
+  while n < top:
+    steps.append(n)
+    n *= 2
+  steps.append(top)
+
+  base = None
+  print('workers  seconds  addrs/s  speedup', file=stderr)
+  for workers in steps:
+    with open(devnull, 'wb') as out:
+      start = perf_counter()
+      count = expand(items, out, chunk, workers, fmt)
+      elapsed = perf_counter() - start
+    base = base or elapsed
+    print(f'{workers:7d}  {elapsed:7.2f}  {count / elapsed:7.0f}  {base / elapsed:6.2f}x',
+      file=stderr)
+
+
+if __name__ == '__main__':
+  parser = ArgumentParser(description='Expand IP ranges into individual addresses.')
+  parser.add_argument('-i', '--input', default='cidr-ranges-list.txt',
+    help='Path to the <CIDR>, "<COMMENT>" list. Default is cidr-ranges-list.txt.')
+  parser.add_argument('-o', '--output', default='-',
+    help='Path to the output file. Default is stdout.')
+  parser.add_argument('-f', '--format', default='text',
+    choices=['text', 'range', 'binary', 'gzip'],
+    help='Output format. Default is text.')
+  parser.add_argument('--merge', default='join',
+    choices=['join', 'first', 'last', 'specific', 'none'],
+    help='How to combine comments of overlapping ranges. Default is join.')
+  parser.add_argument('--chunk', type=int, default=65536,
+    help='Addresses formatted per write. Default is 65536.')
+  parser.add_argument('-w', '--workers', type=int, default=1,
+    help='Processes formatting chunks in parallel. Default is 1.')
+  parser.add_argument('--bench', action='store_true',
+    help='Print the scaling curve over worker counts instead of expanding.')
+  parser.add_argument('--table', metavar='PATH',
+    help='Compile the ranges into a binary range table instead of expanding them.')
+  args = parser.parse_args()
+
+  if args.table:
+    IPv4RangeIndex.from_file(args.input).dump(args.table)
+    exit(0)
 
-re_line = compile(r'(?P<cidr>[\d/\.]+)\s*,\s*"(?P<comm>.*)"$')
-expanded = list()
+  items = ranges(args.input)
+  if args.merge != 'none':
+    items = merge(items, args.merge)
 
-with open('cidr-ranges-list.txt','r') as f:
-  lines = f.readlines()
-  for line in lines:
-    match = re_line.match(line)
-    if match:
-      addrs = IPv4Network(match.group('cidr'))
-      comm = match.group('comm')
-      for addr in addrs:
-        expanded.append(f'{addr}  // {comm}')
+  if args.bench:
+    bench(items, args.chunk, max(args.workers, cpu_count() or 1), args.format)
+    exit(0)
 
-for line in expanded:
-  print(line)
+  out = stdout.buffer if args.output == '-' else open(args.output, 'wb')
+  with out:
+    expand(items, out, args.chunk, args.workers, args.format)
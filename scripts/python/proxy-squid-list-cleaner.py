@@ -3,9 +3,36 @@
 '''Squid Cleaner
 
 This script takes a file with a list of domains in Squid format
-separated by "comma-space" and outputs a new list without
-duplicates, shadows (.domain.com and domain.com <-removes this),
-and overlaps (.domain.com, sub.domain.com <-removes this).
+and outputs a new list without duplicates, shadows (.domain.com
+and domain.com <-removes this), and overlaps (.domain.com,
+sub.domain.com <-removes this).
+
+The list is read as a stream, CHUNK characters at a time, and its
+domains may be separated by commas, spaces or new lines, so both
+the "comma-space" lists and Squid dstdomain files (one domain per
+line, # comments) are accepted, however long their lines are.
+
+Usage:
+    proxy-squid-list-cleaner.py [-q] [-f comma|lines] [--index PATH] INFILE OUTFILE
+    proxy-squid-list-cleaner.py [-q] [-f comma|lines] --index PATH --delta DELTA OUTFILE
+
+Use - for stdin/stdout.  -q prints only the summary instead of a
+line per entry removed, and -f lines writes one domain per line.
+
+With --index, the cleaned list and its trie are saved (pickled) in
+PATH.  With --delta too, INFILE holds changes to that list instead
+(+domain adds it, -domain removes it; no sign adds), which update
+the index and are reported as the entries ADDED, REMOVED, newly
+SHADOWED or OVERLAPPED, or UNCOVERED by them.  Only the entries
+under a changed .domain.com are looked at, so an update costs time
+proportional to the delta, not to the list; loading the index and
+writing the list out are what is left.  The index is a pickle: only
+load ones you wrote.
+
+Domains are indexed in a trie of their labels, last one first
+(sub.domain.com is com -> domain -> sub), so a domain's parents
+are its ancestors in the trie and a single walk over it finds the
+duplicates, shadows and overlaps of the whole list.
 
 It can also check is domains are responsive, but of course this
 can be tricky, because of false positives.
@@ -14,68 +41,266 @@ DATE: 2019-06-26
 '''
 
 
-from sys import argv
-from re import match
+import gc
+import pickle
+import re
+from argparse import ArgumentParser, FileType
+from bisect import bisect_left, insort
+from contextlib import contextmanager
 
 
-class SquidCleaner(object):
-    def __init__(self, infile, outfile):
-        self.domains = [s.strip() for s in
-            sorted(infile.readlines()[0].split(', '))]
+CHUNK = 65536  # characters read at a time
+SEPARATORS = re.compile(r'[\s,]+')
+FORMATS = {'comma': ', ', 'lines': '\n'}
+# A trie node is [children by label, count of domain.com, count of
+# .domain.com]: plain lists and dicts pickle and load fast.
+CHILDREN, PLAIN, DOTTED = 0, 1, 2
+
+
+def tokenize(stream, size=CHUNK):
+    '''Yields the domains in stream, skipping # comments.
 
+    Reads at most `size` characters at a time, so a list on a
+    single giant line is not loaded whole.
+    '''
+    pending = ''  # a domain cut in two by the chunk
+    comment = False
+    for piece in iter(lambda: stream.readline(size), ''):
+        ends = piece.endswith('\n')
+        if comment:
+            comment = not ends
+            continue
+        text, hashed, _ = piece.partition('#')
+        comment = bool(hashed) and not ends
+        items = SEPARATORS.split(pending + text)
+        pending = '' if hashed or ends else items.pop()
+        yield from filter(None, items)
+    if pending:
+        yield pending
+
+
+@contextmanager
+def paused_gc():
+    '''Runs without the garbage collector, enabled again on exit.
+
+    The trie has no cycles, so collections while it is built would
+    only scan its million containers over and over.
+    '''
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class SquidCleaner(object):
+    def __init__(self, infile, outfile, verbose=True, separator=', '):
+        self.verbose = verbose
         self.stats = {
-            'initial': len(self.domains),
+            'initial': 0,
             'duplicate': 0,
             'shadowed': 0,
             'overlapped': 0
         }
 
-        self.drop_duplicates()
-        self.drop_shadows()
-        self.drop_overlaps()
-        outfile.write(', '.join(self.domains))
-
-    def drop_duplicates(self):
-        domains = self.domains.copy()
-        for domain in self.domains:
-            while domains.count(domain) > 1:
-                domains.remove(domain)
-                print(f'DUPLICATE: {domain}')
-                self.stats['duplicate'] += 1
-        self.domains = domains
-
-    def drop_shadows(self):
-        '''Excludes shadowed domains (.domain.com and domain.com <-this).'''
-        domains = self.domains.copy()
-        for domain in self.domains:
-            if domain.startswith('.'):
-                while domains.count(domain[1:]):
-                    domains.remove(domain[1:])
-                    print(f'SHADOWED: {domain[1:]}')
-                    self.stats['shadowed'] += 1
-        self.domains = domains
-
-    def drop_overlaps(self):
-        '''Excludes overlaps (.domain.com and sub.domain.com <-this).'''
-        domains = self.domains.copy()
-        super_domains = [s[1:] for s in domains if s.startswith('.')]
-        for domain in self.domains:
-            for super_domain in super_domains:
-                if match(f'^.+?\.{super_domain}', domain):
-                    try:
-                        domains.remove(domain)
-                        print(f'OVERLAPPED: {domain}')
-                        self.stats['overlapped'] += 1
-                    except ValueError:
-                        pass  # already removed
-        self.domains = domains
+        self.root = [dict(), 0, 0]
+        with paused_gc():
+            for domain in tokenize(infile):
+                self.add(domain)
+                self.stats['initial'] += 1
+            self.clean()
+        self.write(outfile, separator)
+
+    @classmethod
+    def load(cls, path, verbose=True):
+        '''Returns the cleaner saved in an index file.'''
+        sc = cls.__new__(cls)
+        sc.verbose = verbose
+        with open(path, 'rb') as f, paused_gc():
+            sc.root, sc.domains, sc.stats = pickle.load(f)
+        return sc
+
+    def save(self, path):
+        with open(path, 'wb') as f:
+            pickle.dump((self.root, self.domains, self.stats), f, pickle.HIGHEST_PROTOCOL)
+
+    def find(self, domain, create=False):
+        '''Returns (node, dotted, covered) for a domain, or None.
+
+        `covered` tells if a strict parent of it is a .domain.com.
+        '''
+        node, covered = self.root, False
+        dotted = domain.startswith('.')
+        for label in reversed((domain[1:] if dotted else domain).split('.')):
+            covered = covered or node[DOTTED] > 0
+            child = node[CHILDREN].get(label)
+            if child is None:
+                if not create:
+                    return None
+                child = node[CHILDREN][label] = [dict(), 0, 0]
+            node = child
+        return node, dotted, covered
+
+    def add(self, domain):
+        '''Indexes a domain under its labels, last one first.'''
+        node, dotted, _ = self.find(domain, create=True)
+        node[DOTTED if dotted else PLAIN] += 1
+
+    def clean(self):
+        '''Walks the trie once and keeps what is left in self.domains.
+
+        Below a .domain.com every entry is an overlap, and the plain
+        domain.com next to it is a shadow.
+        '''
+        found = {'duplicate': list(), 'shadowed': list(), 'overlapped': list()}
+        self.domains = list()
+        stack = [(child, label, False) for label, child in self.root[CHILDREN].items()]
+        while stack:
+            node, name, covered = stack.pop()
+            if node[DOTTED]:
+                found['duplicate'] += [f'.{name}'] * (node[DOTTED] - 1)
+                (found['overlapped'] if covered else self.domains).append(f'.{name}')
+            if node[PLAIN]:
+                found['duplicate'] += [name] * (node[PLAIN] - 1)
+                if node[DOTTED]:
+                    found['shadowed'].append(name)
+                elif covered:
+                    found['overlapped'].append(name)
+                else:
+                    self.domains.append(name)
+            covered = covered or node[DOTTED] > 0
+            for label, child in node[CHILDREN].items():
+                stack.append((child, f'{label}.{name}', covered))
+
+        for kind in ('duplicate', 'shadowed', 'overlapped'):
+            if self.verbose:
+                for domain in sorted(found[kind]):
+                    print(f'{kind.upper()}: {domain}')
+            self.stats[kind] = len(found[kind])
+        self.domains.sort()
+
+    def states(self, node, name, covered, below=False):
+        '''Returns {domain: state} for the entries at node.
+
+        With `below`, also for the entries under it down to the next
+        .domain.com, since whatever is under that one stays covered.
+        A state is kept, shadowed or overlapped.
+        '''
+        found = dict()
+        stack = [(node, name, covered, True)]
+        while stack:
+            node, name, covered, top = stack.pop()
+            if node[DOTTED]:
+                found[f'.{name}'] = 'overlapped' if covered else 'kept'
+            if node[PLAIN]:
+                found[name] = ('shadowed' if node[DOTTED] else
+                               'overlapped' if covered else 'kept')
+            if below and (top or not node[DOTTED]):
+                for label, child in node[CHILDREN].items():
+                    stack.append((child, f'{label}.{name}', covered or node[DOTTED] > 0, False))
+        return found
+
+    def update(self, added=(), removed=()):
+        '''Applies a delta, removals first, and reports what changed.
+
+        Keeps self.domains and self.stats as a full clean of the
+        updated list would leave them.
+        '''
+        kinds = ('added', 'removed', 'uncovered', 'duplicate', 'shadowed', 'overlapped', 'missing')
+        found = {kind: list() for kind in kinds}
+        steps = [(domain, -1) for domain in removed] + [(domain, 1) for domain in added]
+        for domain, step in steps:
+            where = self.find(domain, create=step > 0)
+            node, dotted, covered = where if where else (None, False, False)
+            count = node[DOTTED if dotted else PLAIN] if node else 0
+            if step < 0 and not count:
+                found['missing'].append(domain)
+                continue
+            self.stats['initial'] += step
+            name = domain[1:] if dotted else domain
+            if count + step > 0 and count > 0:
+                # one copy more or less of an entry that stays
+                node[DOTTED if dotted else PLAIN] += step
+                self.stats['duplicate'] += step
+                if step > 0:
+                    found['duplicate'].append(domain)
+                continue
+
+            before = self.states(node, name, covered, below=dotted)
+            node[DOTTED if dotted else PLAIN] += step
+            after = self.states(node, name, covered, below=dotted)
+
+            for entry in before.keys() | after.keys():
+                old, new = before.get(entry), after.get(entry)
+                if old == new:
+                    continue
+                if old in ('shadowed', 'overlapped'):
+                    self.stats[old] -= 1
+                if new in ('shadowed', 'overlapped'):
+                    self.stats[new] += 1
+                if new == 'kept':
+                    insort(self.domains, entry)
+                    found['added' if old is None else 'uncovered'].append(entry)
+                elif old == 'kept':
+                    del self.domains[bisect_left(self.domains, entry)]
+                    found['removed' if new is None else new].append(entry)
+                elif old is None:
+                    found[new].append(entry)  # added, but left out
+
+        if self.verbose:
+            for kind in kinds:
+                for domain in sorted(found[kind]):
+                    print(f'{kind.upper()}: {domain}')
+        return {kind: len(found[kind]) for kind in kinds}
+
+    def write(self, outfile, separator=', '):
+        '''Writes the domains a slice at a time, not as one string.'''
+        for i in range(0, len(self.domains), CHUNK):
+            if i:
+                outfile.write(separator)
+            outfile.write(separator.join(self.domains[i:i + CHUNK]))
+        if separator == '\n' and self.domains:
+            outfile.write('\n')
 
 
 if __name__ == '__main__':
-    with open(argv[1], 'r') as i, open(argv[2], 'w') as o:
-        sc = SquidCleaner(i, o)
+    parser = ArgumentParser(description='Cleans a Squid list of domains.')
+    parser.add_argument('infile', type=FileType('r'), help='list of domains, or -.')
+    parser.add_argument('outfile', type=FileType('w'), help='cleaned list, or -.')
+    parser.add_argument('-q', '--quiet', action='store_true',
+        help='print only the summary, not every entry removed.')
+    parser.add_argument('-f', '--format', choices=FORMATS, default='comma',
+        help='output separator: comma-space or new lines. Default is comma.')
+    parser.add_argument('--index', metavar='PATH',
+        help='index file, written after cleaning and read by --delta.')
+    parser.add_argument('--delta', action='store_true',
+        help='INFILE holds +domain/-domain changes to the list in --index.')
+    args = parser.parse_args()
+    if args.delta and not args.index:
+        parser.error('--delta needs --index')
+
+    # The trie has no cycles and lives until the script exits: the
+    # collector could only rescan it, even in the last collection at
+    # exit unless it is frozen.
+    gc.disable()
+    with args.infile as i, args.outfile as o:
+        if args.delta:
+            added, removed = list(), list()
+            for token in tokenize(i):
+                (removed if token.startswith('-') else added).append(token.lstrip('+-'))
+            sc = SquidCleaner.load(args.index, not args.quiet)
+            changes = sc.update(added, removed)
+            sc.write(o, FORMATS[args.format])
+            print('\n' + ', '.join(f'{k.capitalize()}: {v}' for k, v in changes.items()))
+        else:
+            sc = SquidCleaner(i, o, not args.quiet, FORMATS[args.format])
+        if args.index:
+            sc.save(args.index)
         print(f'\nInitial: {sc.stats["initial"]}', end=', ')
         print(f'Duplicate: {sc.stats["duplicate"]}', end=', ')
         print(f'Shadowed: {sc.stats["shadowed"]}', end=', ')
         print(f'Overlapped: {sc.stats["overlapped"]}', end=', ')
         print(f'Now: {len(sc.domains)}')
+    gc.freeze()
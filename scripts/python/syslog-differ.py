@@ -4,32 +4,76 @@
 Monitors some log files and send new entries to syslog.
 This script requires a config file to import paths to the files.
 The main concept is that there are a repository with log files
-(which I call 'source files') and an auxiliary repository of
-files ('working files').
-The idea here is to create a copy of source files in the work
-directory, then calculating the diff between the source files
-and the working files.  This difference is sent to syslog and
-appended to the appropriate working file.  Obviously, in the
-first execution the whole file will be sent to syslog and this
-will also happen at the end of the day.
+(which I call 'source files') and a checkpoint per source file,
+kept in the work directory ('workroot').
+Each checkpoint stores the file's device, inode and the byte
+offset up to which it was already sent.  On every run only the
+bytes appended since that offset are read and sent to syslog,
+line by line, so the cost of a run follows the new data and not
+the size of the file.  Obviously, in the first execution the
+whole file will be sent to syslog.  Only complete lines are sent:
+a line still being written is picked up by the next run.
 
 DEPLOYMENT
     1. Create the configuration file
     2. Give this script the necessary permissions
-    3. Configure syslog to forward events to a SIEM
+    3. Configure syslog to forward events to a SIEM, or set the
+       [forward] target to send them to the SIEM directly
     4. Test the script execution
-    5. Automate the execution using cron
-
-NOTE
-When files are rotated the last logs will be lost because
-the new file will be smaller in size than the last one and
-then the new will override the old one.  This way, the last
-log entries written in the old file will be lost.  A routine
-could be created to retrieve the last entries from the old
-file before override it in workroot, but a way to minimize
-such problem is to run this script often.  If it runs every
-30 seconds, for instance, only the last 30 seconds of logs
-will be lost in a day.
+    5. Automate the execution using cron, or run it with --daemon
+
+DAEMON
+With --daemon the script keeps running and watches the groups'
+directories with inotify, so new lines are sent as soon as they
+are written and the process sleeps while nothing happens.  Where
+inotify is not available (or with --poll) it checks every file
+each --interval seconds instead.  With inotify every file is still
+checked each RESCAN seconds, however busy the logs are, and right
+away when the kernel dropped events, so a directory created later
+(the new year's) gets watched and no line is missed.  SIGHUP
+reloads the config file
+and SIGTERM/SIGINT save the checkpoints and exit.
+
+WORKERS
+Files are followed concurrently by a pool of --workers threads, so
+a large file, or one on a slow NFS mount, does not hold the others
+up.  --stats prints the lines sent and the seconds taken per file.
+--bench-tree DIR builds a synthetic logroot of --groups x --files
+logs of --size MB each, then appends --growth MB to every log
+before each of --runs runs and prints how long each run took.
+
+ROTATION
+Files are told apart by (device, inode), not by name.  When the
+file for a group/file pair is not the one in its checkpoint (a new
+day's file, or the old one was renamed), the tail of the old file
+is drained from the saved offset before the new file is read from
+its start.  The old file is looked up at its checkpointed path and
+then by inode among its siblings (f.log renamed to f.log.1).  If
+it was also compressed (f.log.1.gz, .bz2 or .xz, so a new inode),
+the archives named after it are matched by a digest of their first
+FINGERPRINT bytes, also kept in the checkpoint, and the matching
+one is decompressed as a stream: the bytes up to the saved offset
+are skipped and only the lines after it are sent.  A file whose
+first bytes changed under the same inode (copytruncate, or a new
+file reusing the inode) is looked up among the archives too.  A
+file that shrank keeping its first bytes was truncated in place
+and is read again from the start.
+
+FORWARDING
+By default every line goes through the local syslog daemon.  With
+a udp://, tcp:// or tls:// target, lines are sent straight to the
+collector as RFC 5424 messages, framed by octet counting (RFC 6587)
+on TCP/TLS.  Lines are queued in batches, one per block read, and a
+sender thread writes a batch with a single call; the queue is
+bounded, so a slow collector slows reading down instead of filling
+memory.  Checkpoints are saved only after the queue is flushed, and
+a batch that fails is sent again after reconnecting, so a line may
+be delivered twice but is not lost.  The daemon retries for as long
+as it takes; a single run gives up after --deadline seconds, exits
+with status 1 and leaves the checkpoints as they were, so the next
+run sends the same lines again.  A datagram that cannot be sent is
+dropped and the rest of its batch still goes out.  --bench N
+measures lines per second against a local stand-in collector.
 
 Author: Joe Lopes <lopes.id>
 License: MIT
@@ -37,67 +81,735 @@ Date: 2021-08-25
 
 CONFIG
 The configuration file (teslacoil.conf) must have the structure
-below and the correct path to it must be informed in line 71.
+below and the correct path to it must be informed in CONFIG.
     [path]
         logroot  = /var/directory
         workroot = /tmp/teslacoil
     [files]
         group1 = f1.log f2.log
         group2 = f3.log f4.log
+    [forward]
+        target = syslog | udp://host:514 | tcp://host:601 | tls://host:6514
+        app      = teslacoil
+        cafile   = /etc/ssl/certs/siem-ca.pem
+The [forward] section is optional and so are its keys; the TLS
+ones (cafile, certfile, keyfile) apply only to tls:// targets.
 
 CHANGELOG
     2021-09-27
     Added the `encoding` option to solve the `UnicodeDecodeError`.
     In my case, the charset is the same hardcoded here, but other
     people can easily change it setting up the variable.
+    2026-10-18
+    Replaced the working copies and `difflib.ndiff` with byte offset
+    checkpoints in `workroot/checkpoints.json`.
+    Added the [forward] section to send RFC 5424 messages over the
+    network without the local syslog daemon in between.
+    Files are followed by a pool of threads (--workers).
+    The tail of a log compressed by the rotation is read from the
+    archive.
 '''
 
-from datetime import date
-from re import match
-from difflib import ndiff
+import bz2
+import gzip
+import lzma
+import zlib
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from ctypes import CDLL, get_errno
+from ctypes.util import find_library
+from datetime import date, datetime, timezone
+from hashlib import blake2b
+from json import dump, load
 from syslog import syslog, LOG_NOTICE, LOG_ERR
 from configparser import ConfigParser
-from os import makedirs
-from os.path import getsize, isdir
-from shutil import copyfile
+from os import (close, fsdecode, fsencode, getpid, makedirs, pipe, read, replace, scandir,
+                set_blocking, stat)
+from os.path import basename, dirname, isdir, splitext
+from queue import Queue, Empty
+from select import select
+from signal import signal, set_wakeup_fd, SIGHUP, SIGINT, SIGTERM
+from socket import create_connection, gethostname, socket, SOCK_DGRAM, SOCK_STREAM
+from ssl import create_default_context
+from struct import unpack_from
+from threading import Thread
+from time import monotonic, perf_counter, sleep
+from urllib.parse import urlsplit
 
-today = date.today().strftime('%Y-%m-%d')
-year = today[:4]
-re_newlog = r'^- '
+CONFIG = 'teslacoil.conf'
+BLOCK = 1024 * 1024  # bytes read at a time
+INTERVAL = 1.0  # seconds between checks when polling
+RESCAN = 60.0  # seconds between full checks with inotify
+SAVE = 1.0  # seconds between checkpoint saves in daemon mode
+FACILITY = 1  # user-level messages, as in the local syslog
+QUEUE = 64  # batches waiting for the network sender
+BATCH = 10000  # most messages written at once
+RETRY = 30.0  # longest wait between reconnections
+DEADLINE = 60.0  # seconds a single run keeps trying to deliver
+WORKERS = 4  # files followed at the same time
+FINGERPRINT = 4096  # first bytes of a file digested to find its archive
+ARCHIVES = {'.gz': gzip.open, '.bz2': bz2.open, '.xz': lzma.open}
 encoding = 'ISO-8859-1'
-config = ConfigParser()
-config.read('teslacoil.conf')
 
-def full_sync(src_path, dst_path, src):
-    copyfile(src_path, dst_path)
+
+def load_config(path):
+    config = ConfigParser()
+    if not config.read(path):
+        raise FileNotFoundError(path)
+    return config
+
+
+def targets(config):
+    '''Yields (key, path) for today's file of every group/file pair.'''
+    today = date.today().strftime('%Y-%m-%d')
+    for k in config['files'].keys():
+        for f in config['files'][k].split(' '):
+            yield f'{k}/{f}', f'{config["path"]["logroot"]}/{k}/{today[:4]}/{f}.{today}'
+
+
+def load_checkpoints(path):
     try:
-        for line in src:
-            syslog(LOG_NOTICE, line)
+        with open(path, 'r') as f:
+            return load(f)
+    except FileNotFoundError:
+        return dict()
+
+
+def save_checkpoints(path, checkpoints):
+    output.flush()  # only what was delivered is checkpointed
+    with open(f'{path}.tmp', 'w') as f:
+        dump(checkpoints, f)
+    replace(f'{path}.tmp', path)  # atomic, never a half-written file
+
+
+class LocalOutput(object):
+    '''Sends every line through the local syslog daemon.'''
+
+    def send(self, priority, lines):
+        for line in lines:
+            syslog(priority, line)
+
+    def flush(self):
+        return True
+
+    def close(self):
+        pass
+
+
+class NullOutput(LocalOutput):
+    '''Discards every line, for bench_tree().'''
+
+    def send(self, priority, lines):
+        pass
+
+
+class NetworkOutput(object):
+    '''Sends RFC 5424 messages to a collector over UDP, TCP or TLS.
+
+    `url` is scheme://host:port.  Raises ValueError for anything else.
+    With a `timeout`, lines not delivered within that many seconds
+    are given up, and flush() returns False from then on.
+    '''
+
+    def __init__(self, url, app='teslacoil', cafile=None, certfile=None, keyfile=None,
+                 timeout=None):
+        parts = urlsplit(url)
+        if parts.scheme not in ('udp', 'tcp', 'tls') or not parts.hostname or not parts.port:
+            raise ValueError(f'invalid forward target: {url}')
+        self.url = url
+        self.scheme = parts.scheme
+        self.address = (parts.hostname, parts.port)
+        self.context = None
+        if self.scheme == 'tls':
+            self.context = create_default_context(cafile=cafile)
+            if certfile:
+                self.context.load_cert_chain(certfile, keyfile)
+        # HOSTNAME APP-NAME PROCID MSGID STRUCTURED-DATA
+        self.header = f' {gethostname()} {app} {getpid()} - - '.encode()
+        self.sock = None
+        self.timeout = timeout
+        self.deadline = monotonic() + timeout if timeout else None
+        self.failed = False
+        self.queue = Queue(QUEUE)
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def send(self, priority, lines):
+        if lines:
+            self.queue.put((priority, lines))  # blocks while the queue is full
+
+    def flush(self):
+        '''Waits for the queue to empty; returns whether all was sent.'''
+        self.queue.join()
+        return not self.failed
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def connect(self):
+        if self.scheme == 'udp':
+            sock = socket(type=SOCK_DGRAM)
+            sock.connect(self.address)
+            return sock
+        sock = create_connection(self.address, self.timeout)
+        if self.context:
+            sock = self.context.wrap_socket(sock, server_hostname=self.address[0])
+        return sock
+
+    def frame(self, priority, lines):
+        stamp = datetime.now(timezone.utc).isoformat(timespec='microseconds')
+        head = f'<{FACILITY * 8 + priority}>1 {stamp}'.encode() + self.header
+        return [head + line.encode('utf-8') for line in lines]
+
+    def write(self, messages):
+        if self.scheme == 'udp':
+            dropped = 0
+            for message in messages:  # one datagram per message
+                try:
+                    self.sock.send(message)
+                except OSError as e:  # say, refused: the next one may pass
+                    dropped, error = dropped + 1, e
+            if dropped:
+                syslog(LOG_ERR, f'{self.url}: {dropped} messages dropped: {error}')
+        else:
+            self.sock.sendall(b''.join(b'%d %s' % (len(m), m) for m in messages))
+
+    def batches(self):
+        '''Yields lists of framed messages until close() is called.
+
+        Takes whatever is already queued, up to BATCH messages, so a
+        burst of small appends still goes out in a single write.
+        '''
+        while True:
+            item, taken = self.queue.get(), 1
+            messages = list()
+            while item is not None:
+                messages.extend(self.frame(*item))
+                if len(messages) >= BATCH:
+                    break
+                try:
+                    item = self.queue.get_nowait()
+                    taken += 1
+                except Empty:
+                    break
+            if messages:
+                yield messages
+            for _ in range(taken):
+                self.queue.task_done()
+            if item is None:
+                return
+
+    def run(self):
+        delay = 1.0
+        for messages in self.batches():
+            while not self.failed:  # once given up, the rest is dropped
+                try:
+                    if self.sock is None:
+                        self.sock = self.connect()
+                    self.write(messages)
+                    delay = 1.0
+                    break
+                except OSError as e:
+                    syslog(LOG_ERR, f'{self.url}: {e}')
+                    if self.sock:
+                        self.sock.close()
+                        self.sock = None
+                    if self.scheme == 'udp':
+                        break  # a datagram is not worth retrying
+                    if self.deadline:
+                        if monotonic() >= self.deadline:
+                            self.failed = True
+                            break
+                        delay = min(delay, self.deadline - monotonic())
+                    sleep(delay)
+                    delay = min(delay * 2, RETRY)
+        if self.sock:
+            self.sock.close()
+
+
+def open_output(config, target=None, timeout=None):
+    '''Returns the output set in the [forward] section, or by target.'''
+    forward = config['forward'] if config.has_section('forward') else dict()
+    target = target or forward.get('target', 'syslog')
+    if target == 'syslog':
+        return LocalOutput()
+    return NetworkOutput(target, forward.get('app', 'teslacoil'), forward.get('cafile'),
+                         forward.get('certfile'), forward.get('keyfile'), timeout)
+
+
+output = LocalOutput()
+
+
+def send(data, path):
+    '''Sends the lines in data and returns how many were sent.
+
+    Lines end at LF only, and lose the CR before it if any:
+    str.splitlines() would also cut them at VT, FF, FS, GS, RS and
+    NEL (0x85), which are plain bytes in a Latin-1 log.
+    '''
+    try:
+        lines = data.decode(encoding).split('\n')
     except UnicodeDecodeError:
-        syslog(LOG_ERR, f'UnicodeDecodeError: {src_path}')
+        output.send(LOG_ERR, [f'UnicodeDecodeError: {path}'])
+        return 0
+    if data.endswith(b'\n'):
+        lines.pop()
+    lines = [line[:-1] if line.endswith('\r') else line for line in lines]
+    output.send(LOG_NOTICE, lines)
+    return len(lines)
+
+
+def open_log(path):
+    '''Opens a log for reading, decompressing archives as a stream.'''
+    return ARCHIVES.get(splitext(path)[1], open)(path, 'rb')
+
+
+def fingerprint(path, size):
+    '''Returns the digest of the first `size` bytes of path, or None.'''
+    try:
+        with open_log(path) as f:
+            return blake2b(f.read(size), digest_size=16).hexdigest()
+    except (OSError, EOFError, lzma.LZMAError, zlib.error):
+        return None  # unreadable or corrupt: not the archive looked for
+
+
+def tail(path, offset, drain=False):
+    '''Sends the lines appended to path after offset.
+
+    Reads BLOCK bytes at a time and stops at the last complete
+    line, unless `drain` is set (the file will not grow anymore).
+    Returns the offset of the first byte not sent and the number of
+    lines sent.
+    '''
+    lines = 0
+    with open_log(path) as f:
+        f.seek(offset)  # archives decompress and skip up to it
+        pending = b''
+        for block in iter(lambda: f.read(BLOCK), b''):
+            data = pending + block
+            cut = data.rfind(b'\n') + 1
+            if cut:
+                lines += send(data[:cut], path)
+            pending = data[cut:]
+            offset += cut
+        if drain and pending:
+            lines += send(pending, path)
+            offset += len(pending)
+    return offset, lines
+
+
+def find_rotated(checkpoint, archived=False):
+    '''Returns where the checkpointed file is now, or None.
 
-for k in config['files'].keys():
-    for f in config['files'][k].split(' '):
-        sf_path = f'{config["path"]["logroot"]}/{k}/{year}/{f}.{today}'
+    Looks at its path, then by inode among its siblings and last
+    among the archives named after it, by fingerprint.  With
+    `archived`, its inode holds another file now: only archives.
+    '''
+    dev, ino = checkpoint['dev'], checkpoint['ino']
+    name = basename(checkpoint['path'])
+    archives = list()
+    try:
+        st = stat(checkpoint['path'])
+        if (st.st_dev, st.st_ino) == (dev, ino) and not archived:
+            return checkpoint['path']
+    except OSError:
+        pass
+    try:
+        with scandir(dirname(checkpoint['path'])) as it:
+            for entry in it:
+                if entry.inode() == ino and entry.stat().st_dev == dev and not archived:
+                    return entry.path
+                if entry.name.startswith(name) and splitext(entry.name)[1] in ARCHIVES:
+                    archives.append(entry.path)
+    except OSError:
+        return None
+    if checkpoint.get('head_size'):  # nothing to match before the first line
+        for path in sorted(archives):
+            if fingerprint(path, checkpoint['head_size']) == checkpoint['head']:
+                return path
+    return None
+
+
+def follow(key, path, checkpoints):
+    '''Sends what is new in `path` and updates its checkpoint.
+
+    Returns the number of lines sent.
+    '''
+    lines = 0
+    checkpoint = checkpoints.get(key)
+    try:
+        st = stat(path)
+    except FileNotFoundError:
+        st = None
+
+    if checkpoint:
+        same = st is not None and [st.st_dev, st.st_ino] == [checkpoint['dev'], checkpoint['ino']]
+        # same inode, other first bytes: copytruncate, or the inode was reused
+        replaced = same and checkpoint.get('head') is not None and \
+            fingerprint(path, checkpoint['head_size']) != checkpoint['head']
+        if not same or replaced:
+            # rotated: draining the old file if it is still there
+            if st is None and checkpoint['path'] == path:
+                return lines  # gone for now, maybe being rotated; keep the checkpoint
+            old = find_rotated(checkpoint, archived=replaced)
+            if old:
+                lines += tail(old, checkpoint['offset'], drain=True)[1]
+            del checkpoints[key]
+            checkpoint = None
+
+    if st is None:
+        return lines
+
+    offset = checkpoint['offset'] if checkpoint else 0
+    head = checkpoint.get('head') if checkpoint else None
+    if st.st_size < offset:
+        offset, head = 0, None  # truncated in place
+    offset, sent = tail(path, offset)
+    size = min(FINGERPRINT, offset)
+    if head is None or checkpoint.get('head_size') != size:
+        head = fingerprint(path, size)  # only while the file is small
+    checkpoints[key] = {
+        'path': path,
+        'dev': st.st_dev,
+        'ino': st.st_ino,
+        'offset': offset,
+        'head': head,
+        'head_size': size
+    }
+    return lines + sent
+
+
+class Inotify(object):
+    '''Minimal inotify binding over ctypes (Linux).
+
+    Raises OSError where inotify is not available.
+    '''
+    IN_MODIFY = 0x00000002
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+    MASK = IN_MODIFY | IN_MOVED_TO | IN_CREATE
+
+    def __init__(self):
+        library = find_library('c')
+        if not library:
+            raise OSError('libc not found')
+        self.libc = CDLL(library, use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError('inotify not available')
+        self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(get_errno(), 'inotify_init1 failed')
+        self.watches = dict()  # wd -> directory
+
+    def watch(self, directory):
+        wd = self.libc.inotify_add_watch(self.fd, fsencode(directory), self.MASK)
+        if wd < 0:
+            raise OSError(get_errno(), f'inotify_add_watch failed: {directory}')
+        self.watches[wd] = directory
+
+    def clear(self):
+        for wd in list(self.watches):
+            self.libc.inotify_rm_watch(self.fd, wd)
+        self.watches.clear()
+
+    def events(self):
+        '''Returns the (directory, name) of every pending event.
+
+        (None, None) stands for the events the kernel dropped when its
+        queue overflowed.
+        '''
+        found = list()
         try:
-            with open(sf_path, 'r', encoding=encoding) as sf:
-                wf_path = f'{config["path"]["workroot"]}/{k}/{f}'
-                try:
-                    with open(wf_path, 'r+', encoding=encoding) as wf:
-                        # new day clean-up
-                        if getsize(sf_path) < getsize(wf_path):
-                            full_sync(sf_path, wf_path, sf)
-                            continue
-                        try:
-                            for line in ndiff(sf.readlines(), wf.readlines()):
-                                if match(re_newlog, line):
-                                    syslog(LOG_NOTICE, line[2:])
-                                    wf.write(line[2:])
-                        except UnicodeDecodeError:
-                            syslog(LOG_ERR, f'UnicodeDecodeError: {sf_path}')
-                except FileNotFoundError:
-                    if not isdir(f'{config["path"]["workroot"]}/{k}'):
-                        makedirs(f'{config["path"]["workroot"]}/{k}')
-                    full_sync(sf_path, wf_path, sf)
-        except FileNotFoundError:
-            pass
+            data = read(self.fd, 65536)
+        except BlockingIOError:
+            return found
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = unpack_from('iIII', data, pos)
+            # as os.listdir() would: any byte name, same str as targets()
+            name = fsdecode(data[pos + 16:pos + 16 + length].rstrip(b'\0'))
+            if mask & self.IN_Q_OVERFLOW:
+                found.append((None, None))
+            elif wd in self.watches:
+                found.append((self.watches[wd], name))
+            pos += 16 + length
+        return found
+
+
+def timed(key, path, checkpoints):
+    '''Runs follow() and returns (key, lines sent, seconds).'''
+    start = perf_counter()
+    try:
+        lines = follow(key, path, checkpoints)
+    except (OSError, EOFError, lzma.LZMAError, zlib.error) as e:  # a bad archive too
+        syslog(LOG_ERR, f'{key}: {e}')  # the other files go on
+        lines = 0
+    return key, lines, perf_counter() - start
+
+
+def run_once(config, checkpoints, workers=WORKERS):
+    '''Follows every file, `workers` at a time.
+
+    Returns a list of (key, lines sent, seconds), one per file.
+    '''
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        jobs = [pool.submit(timed, key, path, checkpoints)
+                for key, path in targets(config)]
+        return [job.result() for job in jobs]
+
+
+def report(stats, elapsed):
+    '''Prints the stats from run_once(), slowest file first.'''
+    for key, lines, seconds in sorted(stats, key=lambda s: s[2], reverse=True):
+        print(f'{key}\t{lines}\t{seconds:.3f}s')
+    print(f'total\t{sum(s[1] for s in stats)}\t{elapsed:.3f}s')
+
+
+def daemon(config_path, interval=INTERVAL, poll=False, target=None, workers=WORKERS):
+    '''Sends new lines as they are written, until SIGTERM/SIGINT.'''
+    global output
+    flags = {'reload': True, 'stop': False}
+    signal(SIGHUP, lambda *args: flags.update(reload=True))
+    signal(SIGTERM, lambda *args: flags.update(stop=True))
+    signal(SIGINT, lambda *args: flags.update(stop=True))
+    wakeup, wakeup_w = pipe()  # signals wake select() up right away
+    set_blocking(wakeup, False)
+    set_blocking(wakeup_w, False)
+    set_wakeup_fd(wakeup_w)
+
+    inotify = None
+    if not poll:
+        try:
+            inotify = Inotify()
+        except OSError as e:
+            syslog(LOG_ERR, f'inotify unavailable, polling: {e}')
+
+    day = checkpoints = None
+    saved = rescanned = monotonic()
+    every = RESCAN if inotify else interval  # seconds between full passes
+    while not flags['stop']:
+        if flags['reload'] or day != date.today():
+            flags['reload'] = False
+            if checkpoints is not None:  # the workroot may change
+                save_checkpoints(checkpoints_path, checkpoints)
+            day = date.today()
+            config = load_config(config_path)
+            output.close()
+            output = open_output(config, target)
+            checkpoints_path = f'{config["path"]["workroot"]}/checkpoints.json'
+            makedirs(config['path']['workroot'], exist_ok=True)
+            checkpoints = load_checkpoints(checkpoints_path)
+            files = dict()  # directory -> {name: (key, path)}
+            for key, path in targets(config):
+                files.setdefault(dirname(path), dict())[basename(path)] = (key, path)
+            if inotify:
+                inotify.clear()
+                for directory in files:
+                    # a missing directory (new year) is caught by RESCAN
+                    if isdir(directory):
+                        inotify.watch(directory)
+            run_once(config, checkpoints, workers)
+            rescanned = monotonic()
+            save_checkpoints(checkpoints_path, checkpoints)
+
+        timeout = max(0.0, rescanned + every - monotonic())
+        fds = [wakeup, inotify.fd] if inotify else [wakeup]
+        ready = select(fds, [], [], timeout)[0]
+        if wakeup in ready:
+            while read(wakeup, 512) == 512:
+                pass
+
+        if inotify and inotify.fd in ready:
+            for directory, name in set(inotify.events()):
+                if directory is None:
+                    rescanned -= every  # events were lost: a full pass now
+                elif name in files.get(directory, dict()):
+                    timed(*files[directory][name], checkpoints)
+                else:
+                    # a rotated sibling: checking the whole directory
+                    for key, path in files.get(directory, dict()).values():
+                        timed(key, path, checkpoints)
+        if monotonic() - rescanned >= every:
+            if inotify and len(inotify.watches) < len(files):
+                flags['reload'] = True  # a watched directory showed up?
+            run_once(config, checkpoints, workers)
+            rescanned = monotonic()
+        if monotonic() - saved >= SAVE:
+            save_checkpoints(checkpoints_path, checkpoints)
+            saved = monotonic()
+
+    save_checkpoints(checkpoints_path, checkpoints)
+    output.close()
+    set_wakeup_fd(-1)
+    close(wakeup)
+    close(wakeup_w)
+
+
+def receive(server, scheme, count):
+    '''Counts the messages a stand-in collector gets, for bench().
+
+    count is [received, expected, when the last one came].
+    '''
+    if scheme == 'udp':
+        server.settimeout(1.0)
+        try:
+            while count[0] < count[1]:
+                server.recv(65536)
+                count[0] += 1
+                count[2] = perf_counter()
+        except OSError:
+            pass  # timed out: the rest was dropped
+        return
+    conn, _ = server.accept()
+    pending = b''
+    for data in iter(lambda: conn.recv(BLOCK), b''):
+        pending += data
+        pos = 0
+        while True:  # octet counting: LENGTH SP MESSAGE
+            space = pending.find(b' ', pos)
+            if space < 0:
+                break
+            end = space + 1 + int(pending[pos:space])
+            if end > len(pending):
+                break
+            count[0] += 1
+            pos = end
+        pending = pending[pos:]
+        count[2] = perf_counter()
+    conn.close()
+
+
+def bench(count):
+    '''Prints lines/second received by a local stand-in collector.'''
+    lines = [f'bench line {i:08d} ' + 'x' * 100 for i in range(min(count, BLOCK // 128))]
+    for scheme in ('udp', 'tcp'):
+        server = socket(type=SOCK_DGRAM if scheme == 'udp' else SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        if scheme == 'tcp':
+            server.listen(1)
+        out = NetworkOutput(f'{scheme}://127.0.0.1:{server.getsockname()[1]}')
+        start = perf_counter()
+        received = [0, count, start]
+        receiver = Thread(target=receive, args=(server, scheme, received))
+        receiver.start()
+        for sent in range(0, count, len(lines)):
+            out.send(LOG_NOTICE, lines[:count - sent])
+        out.close()
+        receiver.join()
+        elapsed = received[2] - start  # up to the last one received, not the timeout
+        server.close()
+        rate = received[0] / elapsed if elapsed > 0 else 0
+        print(f'{scheme}: {received[0]} of {count} lines received in {elapsed:.3f}s, '
+              f'{rate:,.0f} lines/s')
+
+
+def bench_tree(root, groups, files, size, growth, runs, workers=WORKERS):
+    '''Times run_once() over a synthetic logroot that grows every run.
+
+    Writes `groups` x `files` logs of `size` MB under root, with the
+    config in root/teslacoil.conf, then appends `growth` MB to every
+    log before each run.  Lines are read and counted, not sent.
+    '''
+    global output
+    output = NullOutput()
+    config = ConfigParser()
+    config['path'] = {'logroot': f'{root}/logs', 'workroot': f'{root}/work'}
+    config['files'] = {f'group{g}': ' '.join(f'file{f}.log' for f in range(files))
+                       for g in range(groups)}
+    makedirs(config['path']['workroot'], exist_ok=True)
+    with open(f'{root}/{CONFIG}', 'w') as f:
+        config.write(f)
+
+    stamp = datetime.now().strftime('%b %d %H:%M:%S')
+    line = f'{stamp} bench app[1]: synthetic line '.encode()
+    line += b'x' * (127 - len(line)) + b'\n'  # 128 bytes
+    chunk = line * (2 ** 20 // len(line))
+
+    def grow(mb):
+        length = int(mb * 2 ** 20) // len(line) * len(line)
+        for key, path in targets(config):
+            makedirs(dirname(path), exist_ok=True)
+            with open(path, 'ab') as f:
+                for _ in range(length // len(chunk)):
+                    f.write(chunk)
+                f.write(chunk[:length % len(chunk)])
+
+    grow(size)
+    checkpoints = dict()
+    for run in range(runs + 1):
+        if run:
+            grow(growth)
+        start = perf_counter()
+        stats = run_once(config, checkpoints, workers)
+        elapsed = perf_counter() - start
+        lines = sum(s[1] for s in stats)
+        slowest = max(stats, key=lambda s: s[2])
+        print(f'run {run}: {lines} lines in {elapsed:.3f}s, {lines / elapsed:,.0f} lines/s, '
+              f'slowest {slowest[0]} {slowest[2]:.3f}s')
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Sends new log lines to syslog.')
+    parser.add_argument('-c', '--config', default=CONFIG,
+        help=f'configuration file. Default is {CONFIG}.')
+    parser.add_argument('--daemon', action='store_true',
+        help='keep running and send lines as they are written.')
+    parser.add_argument('--poll', action='store_true',
+        help='in daemon mode, poll instead of using inotify.')
+    parser.add_argument('--interval', type=float, default=INTERVAL,
+        help=f'seconds between polls. Default is {INTERVAL}.')
+    parser.add_argument('--target',
+        help='syslog, or udp|tcp|tls://host:port. Overrides [forward] target.')
+    parser.add_argument('--deadline', type=float, default=DEADLINE,
+        help=f'seconds a single run tries to deliver before it fails. Default is {DEADLINE}.')
+    parser.add_argument('-w', '--workers', type=int, default=WORKERS,
+        help=f'files followed at the same time. Default is {WORKERS}.')
+    parser.add_argument('--stats', action='store_true',
+        help='print the lines sent and the time taken per file.')
+    parser.add_argument('--bench', type=int, metavar='N',
+        help='send N lines to a local stand-in collector and exit.')
+    tree = parser.add_argument_group('tree benchmark')
+    tree.add_argument('--bench-tree', metavar='DIR',
+        help='time runs over a synthetic logroot written in DIR and exit.')
+    tree.add_argument('--groups', type=int, default=4, help='groups. Default is 4.')
+    tree.add_argument('--files', type=int, default=4, help='files per group. Default is 4.')
+    tree.add_argument('--size', type=float, default=8.0,
+        help='initial MB per file. Default is 8.')
+    tree.add_argument('--growth', type=float, default=1.0,
+        help='MB appended per file before each run. Default is 1.')
+    tree.add_argument('--runs', type=int, default=5, help='runs. Default is 5.')
+    args = parser.parse_args()
+
+    if args.bench:
+        bench(args.bench)
+        exit(0)
+
+    if args.bench_tree:
+        bench_tree(args.bench_tree, args.groups, args.files, args.size, args.growth,
+                   args.runs, args.workers)
+        exit(0)
+
+    if args.daemon:
+        daemon(args.config, args.interval, args.poll, args.target, args.workers)
+        exit(0)
+
+    config = load_config(args.config)
+    output = open_output(config, args.target, args.deadline)
+    workroot = config['path']['workroot']
+    makedirs(workroot, exist_ok=True)
+    checkpoints_path = f'{workroot}/checkpoints.json'
+    checkpoints = load_checkpoints(checkpoints_path)
+    start = perf_counter()
+    stats = run_once(config, checkpoints, args.workers)
+    if not output.flush():
+        output.close()
+        syslog(LOG_ERR, f'{output.url}: not delivered, checkpoints not saved')
+        exit(1)
+    save_checkpoints(checkpoints_path, checkpoints)
+    output.close()
+    if args.stats:
+        report(stats, perf_counter() - start)
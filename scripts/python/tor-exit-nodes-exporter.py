@@ -15,6 +15,9 @@ the Node IDs might be duplicated, not the IP addresses.
 
 Having the JSON data, it should be easy to feed any dataset
 or database with the exit nodes data for further use in analytics.
+With `--table <PATH>` the exit addresses are also compiled into a
+binary range table (see `ipv4.IPv4RangeIndex`) with the node IDs as
+comments, ready to be memory-mapped by lookup processes.
 
 Author.: Joe Lopes <lopes.id>
 Date...: 2024-07-04
@@ -22,12 +25,15 @@ License: MIT
 '''
 
 
+from argparse import ArgumentParser
 from datetime import datetime
 from urllib.request import urlopen
 from re import compile, DOTALL
 from json import dumps
 from sys import stderr
 
+from ipv4 import IPv4RangeIndex, PAT_ADDR, cidr_range
+
 
 url = 'https://check.torproject.org/exit-addresses'
 re_exit_node = compile(r'(?P<node>ExitNode\s(?P<node_id>[\dA-Z]+)\nPublished\s(?P<node_published_ts>[\s\d:-]+)\nLastStatus\s(?P<node_status_ts>[\s\d:-]+)\n(?P<exit_addresses>ExitAddress\s[\d.\s:-]+\n?(ExitAddress\s[\d.\s:-]+\n?)*))', DOTALL)
@@ -40,6 +46,11 @@ tor_exit_nodes = {
 }
 unique_addresses = set()
 
+parser = ArgumentParser(description='Export Tor exit nodes as JSON.')
+parser.add_argument('--table', metavar='PATH',
+  help='Also compile the exit addresses into a binary range table.')
+args = parser.parse_args()
+
 
 def fetch_nodes(url):
   try:
@@ -95,3 +106,11 @@ for match in re_exit_node.finditer(raw):
 
 tor_exit_nodes['total_exit_addresses'] = len(tor_exit_nodes['exit_addresses'])
 print(dumps(tor_exit_nodes))
+
+if args.table:
+  ranges = list()
+  for e in tor_exit_nodes['exit_addresses']:
+    if PAT_ADDR.match(e['address']):
+      nodes = ' '.join(n['exit_node']['id'] for n in e['exit_nodes'])
+      ranges.append((*cidr_range(e['address']), f'tor-exit: {nodes}'))
+  IPv4RangeIndex(ranges).dump(args.table)